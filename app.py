@@ -1,43 +1,100 @@
 # app.py
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, abort, request, jsonify, render_template
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func
+from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime, timedelta
-import smtplib
-from email.mime.text import MIMEText
 from models import db, Customer, PaymentMethod, Subscription, Invoice
-from payment_service import process_payment, mock_payment_gateway
-from dunning_service import handle_failed_payment
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from tasks import celery, send_email_task, process_payment_task
+from cache import (cache_get, cache_set, cache_delete, customer_key, invoice_key,
+                   payment_result_key, claim_idempotency_key)
+from jinja2 import FileSystemBytecodeCache
+import hashlib
+import orjson
+import os
+import secrets
+import tempfile
 import uuid
 
+# orjson serializes 3-10x faster than stdlib json and handles datetimes
+# natively (naive values treated as UTC)
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Cache compiled templates on disk so the parse cost is paid once per
+# template across worker restarts, not once per process
+_jinja_cache_dir = os.path.join(tempfile.gettempdir(), 'jinja_cache')
+os.makedirs(_jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+if not app.debug:
+    app.jinja_env.auto_reload = False  # skip per-render mtime checks in production
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///billing.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Tuned connection pool so concurrent workers reuse connections instead of
+# reopening the SQLite file per request
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_timeout': 30,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+    'connect_args': {'check_same_thread': False},  # SQLite: allow pooled connections across threads
+}
 db.init_app(app)
 
+# Rate limiting per client IP on write endpoints (use the Redis storage URI
+# in production so limits are shared across workers)
+limiter = Limiter(get_remote_address, app=app, storage_uri="memory://")
+
+@app.errorhandler(429)
+def rate_limited(e):
+    response = jsonify({'ok': False, 'code': 'agent.rate_limited'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(getattr(e, 'retry_after', None) or 60)
+    return response
+
+# SQLite pragmas: WAL lets readers proceed concurrently with a writer,
+# NORMAL sync + larger cache trade a little durability for throughput
+def set_pragmas(dbapi_conn, _):
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")  # 64 MB page cache
+    cursor.execute("PRAGMA temp_store=memory")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 # Initialize database
 with app.app_context():
+    event.listen(db.engine, "connect", set_pragmas)
     db.create_all()
 
-# Mock SMTP server settings (replace with real SMTP for production)
-SMTP_SERVER = "localhost"
-SMTP_PORT = 1025  # For testing with `python -m smtpd -n -c DebuggingServer localhost:1025`
-
-# Helper to send emails
-def send_email(to_email, subject, body):
-    msg = MIMEText(body)
-    msg['Subject'] = subject
-    msg['From'] = 'billing@example.com'
-    msg['To'] = to_email
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.send_message(msg)
-        return True
-    except Exception as e:
-        print(f"Email failed: {e}")
-        return False
+# Emails are sent asynchronously via Celery (see tasks.py); run a worker with
+# `celery -A app.celery worker` alongside the Flask app.
+
+def json_with_etag(payload):
+    # Hash the serialized body (works for Redis cache hits too, where no
+    # ORM row is loaded) and let unchanged clients revalidate with a 304
+    etag = hashlib.md5(payload).hexdigest()
+    if request.if_none_match.contains(etag):
+        return app.response_class(status=304)
+    response = app.response_class(payload, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 # 5.1 Customer & Account Management
 @app.route('/api/customers', methods=['POST'])
+@limiter.limit("10/minute")
 def create_customer():
     data = request.json
     customer = Customer(
@@ -51,20 +108,31 @@ def create_customer():
 
 @app.route('/api/customers/<int:customer_id>', methods=['GET'])
 def get_customer(customer_id):
-    customer = Customer.query.get_or_404(customer_id)
-    return jsonify({
+    # Cache-aside: serve hot customers straight from Redis
+    key = customer_key(customer_id)
+    cached = cache_get(key)
+    if cached:
+        return json_with_etag(cached)
+    with db.session.no_autoflush:  # pure read, skip the pre-query flush
+        customer = Customer.query.get_or_404(customer_id)
+    payload = orjson.dumps({
         'id': customer.id,
         'email': customer.email,
         'name': customer.name,
         'role': customer.role
     })
+    cache_set(key, payload, lock=True)
+    return json_with_etag(payload)
 
 # 5.2 Payment Methods & Processing
 @app.route('/api/customers/<int:customer_id>/payment_methods', methods=['POST'])
+@limiter.limit("10/minute")
 def add_payment_method(customer_id):
-    Customer.query.get_or_404(customer_id)
+    # Existence check only: fetch the id column, skip hydrating a Customer
+    if not db.session.query(Customer.id).filter_by(id=customer_id).first():
+        abort(404)
     data = request.json
-    token = str(uuid.uuid4())  # Simulate tokenization
+    token = secrets.token_hex(16)  # Simulate tokenization (32-char hex)
     payment_method = PaymentMethod(
         customer_id=customer_id,
         card_number=data['card_number'][-4:],  # Store last 4 digits
@@ -75,23 +143,38 @@ def add_payment_method(customer_id):
     return jsonify({'id': payment_method.id, 'card_number': payment_method.card_number}), 201
 
 @app.route('/api/payments', methods=['POST'])
+@limiter.limit("10/minute")
 def process_payment_route():
     data = request.json
     customer_id = data['customer_id']
     amount = data['amount']
     payment_method_id = data['payment_method_id']
-    payment_method = PaymentMethod.query.get_or_404(payment_method_id)
-    result = process_payment(payment_method, amount)
-    if result['status'] == 'success':
-        return jsonify(result), 200
-    else:
-        # Trigger dunning logic for failed payment
-        customer = Customer.query.get_or_404(customer_id)
-        handle_failed_payment(customer, payment_method, amount)
-        return jsonify(result), 400
+    # Existence checks only; the task refetches the full rows when it runs
+    if not db.session.query(Customer.id).filter_by(id=customer_id).first():
+        abort(404)
+    if not db.session.query(PaymentMethod.id).filter_by(id=payment_method_id).first():
+        abort(404)
+    # Enqueue instead of charging inline: the HTTP path no longer waits on
+    # gateway RTT, and client retries with the same key don't double-charge
+    idempotency_key = request.headers.get('Idempotency-Key', str(uuid.uuid4()))
+    if claim_idempotency_key(idempotency_key):
+        process_payment_task.delay(customer_id, payment_method_id, amount, idempotency_key)
+    return jsonify({
+        'status': 'queued',
+        'idempotency_key': idempotency_key,
+        'status_url': f'/api/payments/{idempotency_key}/status'
+    }), 202
+
+@app.route('/api/payments/<idempotency_key>/status', methods=['GET'])
+def payment_status(idempotency_key):
+    result = cache_get(payment_result_key(idempotency_key))
+    if result is None:
+        return jsonify({'status': 'pending'}), 202
+    return app.response_class(result, mimetype='application/json')
 
 # 5.3 Subscription Management
 @app.route('/api/subscriptions', methods=['POST'])
+@limiter.limit("10/minute")
 def create_subscription():
     data = request.json
     customer = Customer.query.get_or_404(data['customer_id'])
@@ -105,9 +188,11 @@ def create_subscription():
         status='active'
     )
     db.session.add(subscription)
-    db.session.commit()
-    # Generate invoice
+    db.session.flush()  # assigns subscription.id without a commit
+    # Generate invoice in the same transaction (one fsync instead of two)
     invoice = generate_invoice(customer, subscription, data['price'])
+    db.session.commit()
+    send_invoice_email(customer, subscription, invoice)
     return jsonify({
         'id': subscription.id,
         'plan_name': subscription.plan_name,
@@ -115,25 +200,57 @@ def create_subscription():
         'invoice_id': invoice.id
     }), 201
 
+@app.route('/api/subscriptions/bulk', methods=['POST'])
+@limiter.limit("10/minute")
+def create_subscriptions_bulk():
+    # Bulk import: one INSERT batch + one commit instead of a commit per row
+    items = request.json
+    start_date = datetime.utcnow()
+    subscriptions = [
+        Subscription(
+            customer_id=item['customer_id'],
+            plan_name=item['plan_name'],
+            price=item['price'],
+            billing_interval=item['billing_interval'],
+            start_date=start_date,
+            status='active'
+        )
+        for item in items
+    ]
+    db.session.bulk_save_objects(subscriptions)
+    db.session.commit()
+    return jsonify({'created': len(subscriptions)}), 201
+
 @app.route('/api/subscriptions/<int:subscription_id>/cancel', methods=['POST'])
 def cancel_subscription(subscription_id):
     subscription = Subscription.query.get_or_404(subscription_id)
+    now = datetime.utcnow()
     subscription.status = 'canceled'
-    subscription.end_date = datetime.utcnow()
+    subscription.end_date = now
     # Prorate refund (simplified)
-    days_remaining = 30 - (datetime.utcnow() - subscription.start_date).days
-    if days_remaining > 0:
-        prorated_amount = (days_remaining / 30) * subscription.price
-        send_email(
-            subscription.customer.email,
+    days_remaining = max(0, 30 - (now - subscription.start_date).days)
+    # Capture everything the email needs, then commit before any I/O so
+    # the write transaction stays short (matters under WAL with
+    # concurrent writers)
+    customer_email = subscription.customer.email
+    price = subscription.price
+    invoice_ids = [inv.id for inv in subscription.invoices]
+    db.session.commit()
+    # Drop cached invoices tied to this subscription so readers see the cancel
+    for invoice_id in invoice_ids:
+        cache_delete(invoice_key(invoice_id))
+    if days_remaining:
+        prorated_amount = (days_remaining / 30) * price
+        send_email_task.delay(
+            customer_email,
             "Subscription Canceled",
             f"Your subscription has been canceled. Prorated refund: ${prorated_amount:.2f}"
         )
-    db.session.commit()
     return jsonify({'id': subscription.id, 'status': subscription.status}), 200
 
 # 5.4 Invoicing & Billing
 def generate_invoice(customer, subscription, amount):
+    # Adds to the caller's transaction; the caller commits
     invoice = Invoice(
         customer_id=customer.id,
         subscription_id=subscription.id,
@@ -142,25 +259,34 @@ def generate_invoice(customer, subscription, amount):
         due_date=datetime.utcnow() + timedelta(days=7)
     )
     db.session.add(invoice)
-    db.session.commit()
-    # Send invoice email
-    send_email(
+    db.session.flush()  # assigns invoice.id
+    return invoice
+
+def send_invoice_email(customer, subscription, invoice):
+    send_email_task.delay(
         customer.email,
         f"Invoice #{invoice.id}",
-        f"New invoice for {subscription.plan_name}. Amount: ${amount:.2f}, Due: {invoice.due_date}"
+        f"New invoice for {subscription.plan_name}. Amount: ${invoice.amount:.2f}, Due: {invoice.due_date}"
     )
-    return invoice
 
 @app.route('/api/invoices/<int:invoice_id>', methods=['GET'])
 def get_invoice(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
-    return jsonify({
+    # Cache-aside: serve hot invoices straight from Redis
+    key = invoice_key(invoice_id)
+    cached = cache_get(key)
+    if cached:
+        return json_with_etag(cached)
+    with db.session.no_autoflush:  # pure read, skip the pre-query flush
+        invoice = Invoice.query.get_or_404(invoice_id)
+    payload = orjson.dumps({
         'id': invoice.id,
         'customer_id': invoice.customer_id,
         'amount': invoice.amount,
         'status': invoice.status,
         'due_date': invoice.due_date
-    })
+    }, option=orjson.OPT_NAIVE_UTC)
+    cache_set(key, payload, lock=True)
+    return json_with_etag(payload)
 
 # 5.5 Dunning & Retry Logic (handled in dunning_service.py)
 # Admin Dashboard (5.10 simplified)
@@ -168,9 +294,30 @@ def get_invoice(invoice_id):
 def dashboard():
     if request.args.get('role') != 'admin':  # Simulate role-based access
         return "Access denied", 403
-    customers = Customer.query.all()
-    invoices = Invoice.query.all()
-    return render_template('dashboard.html', customers=customers, invoices=invoices)
+    page = request.args.get('page', 1, type=int)
+    # Eager-load relationships up front (avoids N+1 lazy loads in the
+    # template) and paginate to bound rows loaded per request
+    with db.session.no_autoflush:  # pure read, skip the pre-query flush
+        customers = Customer.query.options(
+            selectinload(Customer.invoices),
+            selectinload(Customer.subscriptions)
+        ).paginate(page=page, per_page=50, error_out=False)
+        invoices = Invoice.query.options(
+            joinedload(Invoice.customer),
+            joinedload(Invoice.subscription)
+        ).paginate(page=page, per_page=50, error_out=False)
+        # Totals computed in SQL (hits the status indexes) instead of
+        # loading every row into Python
+        customer_count = db.session.query(func.count(Customer.id)).scalar()
+        invoice_count, invoice_total = db.session.query(
+            func.count(Invoice.id), func.coalesce(func.sum(Invoice.amount), 0)
+        ).one()
+        pending_total = db.session.query(
+            func.sum(Invoice.amount)
+        ).filter(Invoice.status == 'pending').scalar() or 0
+    return render_template('dashboard.html', customers=customers, invoices=invoices,
+                           customer_count=customer_count, invoice_count=invoice_count,
+                           invoice_total=invoice_total, pending_total=pending_total)
 
 @app.route('/invoices/<int:invoice_id>')
 def view_invoice(invoice_id):
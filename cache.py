@@ -0,0 +1,48 @@
+# cache.py
+import redis
+
+# Shared Redis client (same instance as the Celery broker, separate db)
+r = redis.Redis(host='localhost', port=6379, db=1)
+
+CACHE_TTL = 300  # 5 minutes
+
+def customer_key(customer_id):
+    return f"billing:customer:{customer_id}:v1"
+
+def invoice_key(invoice_id):
+    return f"billing:invoice:{invoice_id}:v1"
+
+def cache_get(key):
+    # Treat an unreachable Redis as a cache miss so reads still work
+    try:
+        return r.get(key)
+    except redis.RedisError:
+        return None
+
+def cache_set(key, payload, ttl=CACHE_TTL, lock=False):
+    try:
+        # Stampede protection (lock=True): only the request holding the
+        # short-lived lock repopulates the key; concurrent misses just
+        # serve from the DB
+        if lock and not r.set(f"{key}:lock", 1, nx=True, ex=5):
+            return
+        r.setex(key, ttl, payload)
+    except redis.RedisError:
+        pass
+
+def payment_result_key(idempotency_key):
+    return f"payment:result:{idempotency_key}"
+
+def claim_idempotency_key(idempotency_key, ttl=86400):
+    # True if this key is fresh (safe to enqueue); False if a previous
+    # request already claimed it. Fails open if Redis is unreachable.
+    try:
+        return bool(r.set(f"payment:key:{idempotency_key}", 1, nx=True, ex=ttl))
+    except redis.RedisError:
+        return True
+
+def cache_delete(*keys):
+    try:
+        r.delete(*keys)
+    except redis.RedisError:
+        pass
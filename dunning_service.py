@@ -1,20 +1,51 @@
 # dunning_service.py
+import random
 from datetime import datetime, timedelta
+from models import db, RetryAttempt, Subscription
+from tasks import send_email_task, retry_payment_task
 
-def handle_failed_payment(customer, payment_method, amount):
-    # Simplified retry logic: try once more after 2 days
-    retry_date = datetime.utcnow() + timedelta(days=2)
-    # Simulate storing retry attempt (in production, store in DB)
-    print(f"Scheduled retry for {customer.email} on {retry_date}")
-    # Send dunning email
-    send_email(
+MAX_RETRIES = 3
+RETRY_JITTER = 60  # seconds of random spread so retries don't herd
+
+def retry_delay(attempt_num):
+    # Exponential backoff capped at a day, plus jitter
+    return min(2 ** attempt_num * 3600, 86400) + random.uniform(0, RETRY_JITTER)
+
+def handle_failed_payment(customer, payment_method, amount, attempt_num=1):
+    if attempt_num > MAX_RETRIES:
+        escalate_failed_payment(customer, amount)
+        return
+    delay = retry_delay(attempt_num)
+    retry_at = datetime.utcnow() + timedelta(seconds=delay)
+    # Persist the attempt so dunning state survives restarts
+    attempt = RetryAttempt(
+        payment_method_id=payment_method.id,
+        attempt_num=attempt_num,
+        next_retry_at=retry_at,
+        status='scheduled'
+    )
+    db.session.add(attempt)
+    db.session.commit()
+    retry_payment_task.apply_async(
+        args=[customer.id, payment_method.id, amount, attempt_num],
+        countdown=delay
+    )
+    # Send dunning email asynchronously
+    send_email_task.delay(
         customer.email,
         "Payment Failed",
-        f"Payment of ${amount:.2f} failed. We'll retry on {retry_date}. Please update your payment method."
+        f"Payment of ${amount:.2f} failed. We'll retry on {retry_at}. Please update your payment method."
     )
-    # In production, implement multiple retries and escalation (e.g., suspend after 3 failures)
 
-def send_email(to_email, subject, body):
-    # Reuse email function from app.py (simplified here for clarity)
-    print(f"Mock sending email to {to_email}: {subject} - {body}")
-    return True
\ No newline at end of file
+def escalate_failed_payment(customer, amount):
+    # Out of retries: suspend the customer's active subscriptions
+    Subscription.query.filter_by(customer_id=customer.id, status='active').update(
+        {'status': 'suspended'}
+    )
+    db.session.commit()
+    send_email_task.delay(
+        customer.email,
+        "Subscription Suspended",
+        f"Payment of ${amount:.2f} failed after {MAX_RETRIES} retries. "
+        "Your subscription has been suspended; update your payment method to reactivate."
+    )
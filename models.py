@@ -11,14 +11,14 @@ class Customer(db.Model):
 
 class PaymentMethod(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
     card_number = db.Column(db.String(4))  # Last 4 digits
-    token = db.Column(db.String(36))  # Mock tokenized card
+    token = db.Column(db.String(36))  # Mock tokenized card (32-char hex token)
     customer = db.relationship('Customer', backref=db.backref('payment_methods', lazy=True))
 
 class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
     plan_name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
     billing_interval = db.Column(db.String(20), nullable=False)  # 'monthly' or 'yearly'
@@ -29,11 +29,23 @@ class Subscription(db.Model):
 
 class Invoice(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
-    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False, index=True)
     amount = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='pending')  # 'pending', 'paid', 'failed'
     due_date = db.Column(db.DateTime, nullable=False)
     customer = db.relationship('Customer', backref=db.backref('invoices', lazy=True))
     subscription = db.relationship('Subscription', backref=db.backref('invoices', lazy=True))
-    
\ No newline at end of file
+    
+class RetryAttempt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    payment_method_id = db.Column(db.Integer, db.ForeignKey('payment_method.id'), nullable=False, index=True)
+    attempt_num = db.Column(db.Integer, nullable=False)
+    next_retry_at = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), default='scheduled')  # 'scheduled', 'succeeded', 'failed'
+    payment_method = db.relationship('PaymentMethod', backref=db.backref('retry_attempts', lazy=True))
+
+# Composite/covering indexes for the dashboard and dunning query patterns
+db.Index('ix_invoice_customer_status', Invoice.customer_id, Invoice.status)
+db.Index('ix_invoice_due_date', Invoice.due_date)
+db.Index('ix_subscription_customer_status', Subscription.customer_id, Subscription.status)
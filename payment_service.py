@@ -1,12 +1,19 @@
 # payment_service.py
-import random
+import itertools
+import os
+import time
+
+# Monotonic transaction-id counter seeded from the clock; cheaper than
+# random.randint and collision-free within a process
+_txn_counter = itertools.count(time.time_ns())
 
 def mock_payment_gateway(token, amount):
-    # Simulate payment processing (70% success rate)
-    if random.random() < 0.7:
-        return {'status': 'success', 'transaction_id': str(random.randint(1000, 9999))}
+    # Simulate payment processing (~70% success rate: 179/256)
+    # os.urandom avoids the thread-locked Mersenne Twister on the hot path
+    if os.urandom(1)[0] < 179:
+        return {'status': 'success', 'transaction_id': f"{next(_txn_counter):08x}"}
     return {'status': 'failed', 'error': 'insufficient_funds'}
 
 def process_payment(payment_method, amount):
     result = mock_payment_gateway(payment_method.token, amount)
-    return result
\ No newline at end of file
+    return result
@@ -0,0 +1,120 @@
+# tasks.py
+from celery import Celery
+import json
+import smtplib
+import threading
+from email.mime.text import MIMEText
+
+celery = Celery('billing', broker='redis://localhost:6379/0')
+
+# Mock SMTP server settings (replace with real SMTP for production)
+SMTP_SERVER = "localhost"
+SMTP_PORT = 1025  # For testing with `python -m smtpd -n -c DebuggingServer localhost:1025`
+
+# One persistent SMTP connection per worker thread: amortizes the TCP
+# handshake + EHLO over many emails instead of paying it per message
+_smtp_local = threading.local()
+
+def get_smtp_connection():
+    conn = getattr(_smtp_local, 'conn', None)
+    if conn is not None:
+        try:
+            conn.noop()
+            return conn
+        except (smtplib.SMTPServerDisconnected, OSError):
+            pass  # stale connection, reconnect below
+    conn = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    _smtp_local.conn = conn
+    return conn
+
+def build_message(to_email, subject, body):
+    msg = MIMEText(body)
+    msg['Subject'] = subject
+    msg['From'] = 'billing@example.com'
+    msg['To'] = to_email
+    return msg
+
+@celery.task(bind=True, autoretry_for=(smtplib.SMTPException,), retry_backoff=True, max_retries=5)
+def send_email_task(self, to_email, subject, body):
+    get_smtp_connection().send_message(build_message(to_email, subject, body))
+    return True
+
+@celery.task(bind=True, autoretry_for=(smtplib.SMTPException,), retry_backoff=True, max_retries=5)
+def send_emails_task(self, messages):
+    # Batch dispatch: [(to, subject, body), ...] over a single connection
+    conn = get_smtp_connection()
+    for to_email, subject, body in messages:
+        conn.send_message(build_message(to_email, subject, body))
+    return len(messages)
+
+@celery.task(bind=True, autoretry_for=(smtplib.SMTPException,), retry_backoff=True, max_retries=5)
+def dunning_batch_task(self, attempt_ids):
+    # Send reminders for a batch of scheduled retries over one SMTP
+    # session; the server pipelines the messages back-to-back
+    from app import app
+    from models import RetryAttempt
+    with app.app_context():
+        attempts = RetryAttempt.query.filter(
+            RetryAttempt.id.in_(attempt_ids), RetryAttempt.status == 'scheduled'
+        ).all()
+        conn = get_smtp_connection()
+        for attempt in attempts:
+            customer = attempt.payment_method.customer
+            conn.send_message(build_message(
+                customer.email,
+                "Payment Retry Reminder",
+                f"We will retry your failed payment on {attempt.next_retry_at}. "
+                "Please make sure your payment method is up to date."
+            ))
+        return len(attempts)
+
+@celery.task(bind=True)
+def process_payment_task(self, customer_id, payment_method_id, amount, idempotency_key):
+    # Deferred imports: app imports tasks at module load, so importing app
+    # here (at call time, inside the worker) avoids the cycle
+    from app import app
+    from models import Customer, PaymentMethod
+    from payment_service import process_payment
+    from dunning_service import handle_failed_payment
+    from cache import cache_set, payment_result_key
+    with app.app_context():
+        try:
+            payment_method = PaymentMethod.query.get(payment_method_id)
+            if payment_method is None:
+                # Deleted between enqueue and execution
+                result = {'status': 'error', 'error': 'payment_method_not_found'}
+            else:
+                result = process_payment(payment_method, amount)
+                if result['status'] != 'success':
+                    customer = Customer.query.get(customer_id)
+                    handle_failed_payment(customer, payment_method, amount)
+        except Exception as e:
+            # Record a terminal state before re-raising: the poller would
+            # otherwise see 'pending' forever while the 24h idempotency
+            # claim blocks a client retry
+            cache_set(payment_result_key(idempotency_key),
+                      json.dumps({'status': 'error', 'error': str(e)}), ttl=86400)
+            raise
+        # Store the outcome for the status-polling endpoint
+        cache_set(payment_result_key(idempotency_key), json.dumps(result), ttl=86400)
+        return result
+
+@celery.task(bind=True)
+def retry_payment_task(self, customer_id, payment_method_id, amount, attempt_num):
+    from app import app
+    from models import db, Customer, PaymentMethod, RetryAttempt
+    from payment_service import process_payment
+    from dunning_service import handle_failed_payment
+    with app.app_context():
+        payment_method = PaymentMethod.query.get(payment_method_id)
+        result = process_payment(payment_method, amount)
+        attempt = RetryAttempt.query.filter_by(
+            payment_method_id=payment_method_id, attempt_num=attempt_num
+        ).order_by(RetryAttempt.id.desc()).first()
+        if attempt:
+            attempt.status = 'succeeded' if result['status'] == 'success' else 'failed'
+        db.session.commit()
+        if result['status'] != 'success':
+            customer = Customer.query.get(customer_id)
+            handle_failed_payment(customer, payment_method, amount, attempt_num + 1)
+        return result
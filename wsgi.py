@@ -0,0 +1,7 @@
+# wsgi.py
+# Production entry point; run with:
+#   gunicorn -w $(nproc) -k gthread --threads 8 --preload wsgi:app
+from app import app
+
+if __name__ == '__main__':
+    app.run()